@@ -1,15 +1,22 @@
 import asyncio
-import html
-import json
+import logging
+import logging.handlers
 import os
+import queue
+import re
+from collections import OrderedDict
+from dataclasses import dataclass
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
+import httpx
+import orjson
 from dotenv import load_dotenv
-from supabase import create_client, Client as SupabaseClient
+from supabase import acreate_client
 from telegram.constants import ParseMode
-from telegram.ext import Application, ApplicationBuilder, ContextTypes
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from telegram.ext import AIORateLimiter, Application, ApplicationBuilder, ContextTypes
 
 # ===================== Config & Env =====================
 
@@ -20,40 +27,128 @@ TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID", "")
 SUPABASE_URL = os.getenv("SUPABASE_URL", "")
 SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("SUPABASE_ANON_KEY") or ""
 SUPABASE_TABLE = os.getenv("SUPABASE_TABLE", "instamart_products")
+# Only the columns format_message/product_key read (the scraper writes these; override if your table has tile_* too)
+SUPABASE_COLUMNS = os.getenv(
+    "SUPABASE_COLUMNS", "product_id,var_id,name,mrp,offer_price,store_price,sku,discount"
+)
 POLL_MINUTES = int(os.getenv("POLL_MINUTES", "10"))
+# Push alerts from Supabase Realtime row changes; once subscribed, polling only runs as an
+# hourly safety net (and drops back to POLL_MINUTES if the realtime listener dies)
+REALTIME = os.getenv("SUPABASE_REALTIME", "0") == "1"
+SAFETY_SCAN_MINUTES = 60
 
 if not TELEGRAM_BOT_TOKEN or not TELEGRAM_CHAT_ID or not SUPABASE_URL or not SUPABASE_KEY:
     raise SystemExit(
         "Missing env. Set TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY (or ANON)."
     )
 
-CACHE_FILE = Path("notified_cache.json")   # stores last notified % per (product_id:var_id)
+CACHE_FILE = Path("notified_cache.json")   # compacted snapshot: last notified % per (product_id:var_id)
+CACHE_LOG = Path("notified_cache.log")     # append-only journal of updates since the last snapshot
+CACHE_COMPACT_EVERY = 1000                 # journal lines before folding them into the snapshot
+CACHE_MAX_KEYS = 50_000                    # LRU cap; least recently notified keys are dropped
+SCAN_STATE_FILE = Path("last_scan.json")   # updated_at watermark of the last clean scan
+WATERMARK_OVERLAP = timedelta(minutes=1)   # re-read a little history to absorb clock skew with the DB
 PAGE_SIZE = 1000                           # Supabase pagination
+FETCH_CONCURRENCY = 8                      # pages requested in parallel per wave
+MIN_DISCOUNT = 70                          # alert threshold (%), also pushed down as discount_pct filter
+SEND_CONCURRENCY = 4                       # in-flight sends; AIORateLimiter paces them to the one chat's limit
+DIGEST_MAX_ALERTS = 10                     # alerts folded into one Telegram message
+DIGEST_MAX_CHARS = 3900                    # stay under Telegram's 4096-char message limit
+DIGEST_SEP = "\n\n"
+
+log = logging.getLogger("instabot")
+
+_PCT_RE = re.compile(r"(\d+)")
+IST = timezone(timedelta(hours=5, minutes=30))
+_HTML_TT = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;"})
 
 # ===================== Helpers =====================
 
-def load_cache() -> Dict[str, int]:
+_CACHE: "OrderedDict[str, int]" = OrderedDict()   # in-memory view (oldest first), loaded once in main()
+_journal_lines = 0
+
+def remember(cache: "OrderedDict[str, int]", key: str, pct: int) -> None:
+    cache[key] = pct
+    cache.move_to_end(key)
+    while len(cache) > CACHE_MAX_KEYS:
+        cache.popitem(last=False)
+
+def load_cache() -> "OrderedDict[str, int]":
+    # Snapshot first, then replay the journal on top of it.
+    cache: "OrderedDict[str, int]" = OrderedDict()
     try:
         if CACHE_FILE.exists():
-            return json.loads(CACHE_FILE.read_text(encoding="utf-8"))
+            data = orjson.loads(CACHE_FILE.read_bytes())
+            # [[key, pct], ...] in LRU order; older snapshots were a plain {key: pct} object
+            for key, pct in (data.items() if isinstance(data, dict) else data):
+                remember(cache, key, pct)
+    except Exception:
+        pass
+    try:
+        if CACHE_LOG.exists():
+            for line in CACHE_LOG.read_bytes().splitlines():
+                try:
+                    for key, pct in orjson.loads(line).items():
+                        remember(cache, key, pct)
+                except orjson.JSONDecodeError:
+                    pass   # torn last line after a crash
     except Exception:
         pass
-    return {}
+    return cache
 
-def save_cache(cache: Dict[str, int]) -> None:
+def save_cache(cache: "OrderedDict[str, int]") -> None:
+    # Full rewrite (compaction); the journal is dropped once the snapshot is in place.
+    global _journal_lines
     try:
-        CACHE_FILE.write_text(json.dumps(cache, indent=2), encoding="utf-8")
+        tmp = CACHE_FILE.with_suffix(".tmp")
+        tmp.write_bytes(orjson.dumps(list(cache.items())))
+        tmp.replace(CACHE_FILE)
+        CACHE_LOG.unlink(missing_ok=True)
+        _journal_lines = 0
     except Exception as e:
-        print("[cache] write failed:", e)
+        log.warning("[cache] write failed: %s", e)
+
+def append_cache(cache: "OrderedDict[str, int]", dirty: Dict[str, int]) -> None:
+    # Append only the entries changed this scan; compact every CACHE_COMPACT_EVERY lines.
+    global _journal_lines
+    if not dirty:
+        return
+    try:
+        with CACHE_LOG.open("ab") as f:
+            f.write(b"".join(orjson.dumps({k: v}) + b"\n" for k, v in dirty.items()))
+        _journal_lines += len(dirty)
+    except Exception as e:
+        log.warning("[cache] journal append failed: %s", e)
+        return
+    if _journal_lines >= CACHE_COMPACT_EVERY:
+        save_cache(cache)
+
+def load_watermark() -> Optional[str]:
+    try:
+        if SCAN_STATE_FILE.exists():
+            return orjson.loads(SCAN_STATE_FILE.read_bytes()).get("last_scan_ts")
+    except Exception:
+        pass
+    return None   # no watermark -> full scan
+
+def save_watermark(ts: datetime) -> None:
+    try:
+        SCAN_STATE_FILE.write_bytes(orjson.dumps({"last_scan_ts": ts.isoformat()}))
+    except Exception as e:
+        log.warning("[scan] watermark write failed: %s", e)
 
 def parse_percent(s: Any) -> Optional[int]:
     if s is None:
         return None
-    import re
-    m = re.search(r"(\d+)", str(s))
+    m = _PCT_RE.search(s if isinstance(s, str) else str(s))
     return int(m.group(1)) if m else None
 
 def compute_pct(mrp: Any, offer: Any) -> Optional[int]:
+    # PostgREST returns numeric columns as JSON numbers; only strings need the parsing path.
+    if isinstance(mrp, (int, float)) and isinstance(offer, (int, float)):
+        if mrp <= 0 or offer > mrp:
+            return None
+        return round((mrp - offer) / mrp * 100)
     try:
         mrp_f = float(mrp)
         offer_f = float(offer)
@@ -63,18 +158,55 @@ def compute_pct(mrp: Any, offer: Any) -> Optional[int]:
     except Exception:
         return None
 
-def normalize_discount(row: Dict[str, Any]) -> Optional[int]:
-    # Prefer explicit "discount" (e.g., "72%") else compute from mrp/offer_price.
-    pct = parse_percent(row.get("discount"))
-    if pct is not None:
-        return pct
-    return compute_pct(row.get("mrp"), row.get("offer_price"))
-
 def product_key(row: Dict[str, Any]) -> str:
     pid = row.get("product_id") or row.get("productId") or "?"
     vid = row.get("var_id") or "default"
     return f"{pid}:{vid}"
 
+@dataclass(frozen=True, slots=True)
+class Deal:
+    # A row at/above MIN_DISCOUNT with its display fields resolved once.
+    key: str
+    pct: int
+    name: Any
+    tile: Any
+    mrp: Any
+    offer: Any
+    pid: Any
+    vid: Any
+    sku: Any
+
+def to_deal(row: Dict[str, Any], key: str, pct: int) -> Deal:
+    return Deal(
+        key=key,
+        pct=pct,
+        name=row.get("name") or "(no name)",
+        tile=row.get("tile_name") or row.get("category") or row.get("tile_id") or "—",
+        mrp=row.get("mrp"),
+        offer=row.get("offer_price") or row.get("store_price"),
+        pid=row.get("product_id") or row.get("productId") or "—",
+        vid=row.get("var_id") or "default",
+        sku=row.get("sku") or "—",
+    )
+
+def hot_rows(rows: List[Dict[str, Any]], cache: Dict[str, int]) -> List[Deal]:
+    # Single pass over the batch; returns the rows that deserve a new alert.
+    out: List[Deal] = []
+    for row in rows:
+        key = product_key(row)
+        prev = cache.get(key)
+        # Prefer explicit "discount" (e.g., "72%") else compute from mrp/offer_price.
+        pct = parse_percent(row.get("discount"))
+        if prev is not None and pct is not None and pct <= prev:
+            continue   # already alerted at this level; skip the price math
+        if pct is None:
+            pct = compute_pct(row.get("mrp"), row.get("offer_price"))
+        if pct is None or pct < MIN_DISCOUNT:
+            continue
+        if prev is None or prev < MIN_DISCOUNT or pct > prev:
+            out.append(to_deal(row, key, pct))
+    return out
+
 def fmt_money(v: Any) -> str:
     if v is None or v == "":
         return "-"
@@ -88,89 +220,222 @@ def fmt_money(v: Any) -> str:
         return str(v)
 
 def now_ist_str() -> str:
-    ist = timezone(timedelta(hours=5, minutes=30))
-    return datetime.now(ist).strftime("%Y-%m-%d %H:%M:%S")
-
-def format_message(row: Dict[str, Any], pct: int) -> str:
-    name = row.get("name") or "(no name)"
-    tile = row.get("tile_name") or row.get("category") or row.get("tile_id") or "—"
-    mrp = fmt_money(row.get("mrp"))
-    offer = fmt_money(row.get("offer_price") or row.get("store_price"))
-    pid = row.get("product_id") or row.get("productId") or "—"
-    vid = row.get("var_id") or "default"
-    sku = row.get("sku") or "—"
+    return datetime.now(IST).strftime("%Y-%m-%d %H:%M:%S")
 
+def esc(v: Any) -> str:
+    # Single-pass HTML escape for Telegram's HTML parse mode
+    return (v if isinstance(v, str) else str(v)).translate(_HTML_TT)
+
+def format_message(deal: Deal, ts: str) -> str:
     return (
-        f"🔥 <b>{pct}% OFF</b>\n"
-        f"<b>{html.escape(str(name))}</b>\n"
-        f"Tile: <i>{html.escape(str(tile))}</i>\n"
-        f"MRP: {mrp} | Offer: {offer}\n"
-        f"SKU: {html.escape(str(sku))}\n"
-        f"ID: {pid} / {vid}\n"
-        f"⏱ {now_ist_str()}"
+        f"🔥 <b>{deal.pct}% OFF</b>\n"
+        f"<b>{esc(deal.name)}</b>\n"
+        f"Tile: <i>{esc(deal.tile)}</i>\n"
+        f"MRP: {fmt_money(deal.mrp)} | Offer: {fmt_money(deal.offer)}\n"
+        f"SKU: {esc(deal.sku)}\n"
+        f"ID: {deal.pid} / {deal.vid}\n"
+        f"⏱ {ts}"
     )
 
-# ===================== Supabase =====================
-
-def supabase_client() -> SupabaseClient:
-    return create_client(SUPABASE_URL, SUPABASE_KEY)
-
-# >>> Make this SYNC (not async) <<<
-def fetch_all_rows(sb: SupabaseClient) -> List[Dict[str, Any]]:
-    # Select * so we don't break if some columns are missing (e.g., tile_id)
-    out: List[Dict[str, Any]] = []
-    start = 0
+# ===================== Supabase (PostgREST) =====================
+
+# One long-lived async HTTP/2 client straight to PostgREST: keeps the TLS connection warm
+# across scans and keeps the fetch on the event loop (no worker-thread hop).
+_HTTP = httpx.AsyncClient(
+    base_url=f"{SUPABASE_URL}/rest/v1",
+    headers={"apikey": SUPABASE_KEY, "Authorization": f"Bearer {SUPABASE_KEY}"},
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=16),
+    timeout=30,
+)
+
+async def fetch_page(start: int, since: Optional[str] = None, count: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    # Filter server-side on the generated discount_pct column (see sql/001_discount_pct.sql)
+    # and, when a watermark is known, on rows touched since then (sql/002_updated_at.sql).
+    params = {
+        "select": SUPABASE_COLUMNS,
+        "discount_pct": f"gte.{MIN_DISCOUNT}",
+        "order": "product_id,var_id",   # stable, unique order so concurrent pages neither skip nor repeat rows
+        "limit": str(PAGE_SIZE),
+        "offset": str(start),
+    }
+    if since:
+        params["updated_at"] = f"gte.{since}"
+    headers = {"Prefer": f"count={count}"} if count else None
+    resp = await _HTTP.get(f"/{SUPABASE_TABLE}", params=params, headers=headers)
+    resp.raise_for_status()
+    # Content-Range: "0-999/2500" (or ".../*" when no count was asked for)
+    total = resp.headers.get("content-range", "*").rpartition("/")[2]
+    return orjson.loads(resp.content), (int(total) if total.isdigit() else None)
+
+async def fetch_all_rows(since: Optional[str] = None) -> List[Dict[str, Any]]:
+    # Only the first page asks for a count, and only an estimated one (exact below PostgREST's
+    # max-rows, planner estimate above). The rest is fetched in waves of at most FETCH_CONCURRENCY
+    # pages, stopping at the first short page, so a stale estimate can't fan out into empty requests.
+    out, total = await fetch_page(0, since, "estimated")
+    if len(out) < PAGE_SIZE:
+        return out
+
+    start = PAGE_SIZE
     while True:
-        end = start + PAGE_SIZE - 1
-        resp = sb.table(SUPABASE_TABLE).select("*", count="exact").range(start, end).execute()
-        data = resp.data or []
-        out.extend(data)
-        if len(data) < PAGE_SIZE:
-            break
-        start += PAGE_SIZE
-    return out
+        # Past the estimate (or without one), keep paging one page at a time
+        remaining = -(-((total or 0) - start) // PAGE_SIZE)
+        wave = min(FETCH_CONCURRENCY, max(remaining, 1))
+        pages = await asyncio.gather(*(fetch_page(start + i * PAGE_SIZE, since) for i in range(wave)))
+        for rows, _ in pages:
+            out.extend(rows)
+        if any(len(rows) < PAGE_SIZE for rows, _ in pages):
+            return out
+        start += wave * PAGE_SIZE
 
 # ===================== Job: scan & notify =====================
 
+Digest = Tuple[List[Tuple[str, int]], str]   # ((key, pct) alerts covered, message text)
+
+def build_digests(pending: Dict[str, Tuple[int, str]]) -> List[Digest]:
+    # Pack alerts into as few messages as the size/count limits allow.
+    digests: List[Digest] = []
+    items: List[Tuple[str, int]] = []
+    blocks: List[str] = []
+    size = 0
+    for key, (pct, text) in pending.items():
+        if blocks and (len(blocks) == DIGEST_MAX_ALERTS
+                       or size + len(DIGEST_SEP) + len(text) > DIGEST_MAX_CHARS):
+            digests.append((items, DIGEST_SEP.join(blocks)))
+            items, blocks, size = [], [], 0
+        size += (len(DIGEST_SEP) if blocks else 0) + len(text)
+        items.append((key, pct))
+        blocks.append(text)
+    if blocks:
+        digests.append((items, DIGEST_SEP.join(blocks)))
+    return digests
+
+async def send_digest(app: Application, sem: asyncio.Semaphore, digest: Digest) -> List[Tuple[str, int]]:
+    items, text = digest
+    async with sem:
+        await app.bot.send_message(
+            chat_id=int(TELEGRAM_CHAT_ID),
+            text=text,
+            parse_mode=ParseMode.HTML,
+            disable_web_page_preview=True,
+        )
+    return items
+
+_NOTIFY_LOCK = asyncio.Lock()   # scan and realtime callbacks share the cache
+
+def is_transient(exc: BaseException) -> bool:
+    # Worth retrying next scan: rate limits, timeouts, connection errors. BadRequest
+    # (e.g. an oversize message) subclasses NetworkError but will fail the same way again.
+    return isinstance(exc, (RetryAfter, NetworkError)) and not isinstance(exc, BadRequest)
+
+async def notify_rows(app: Application, rows: List[Dict[str, Any]]) -> Tuple[int, int]:
+    # Returns (sent, retry): alerts delivered, and alerts that failed transiently.
+    async with _NOTIFY_LOCK:
+        return await _notify_rows(app, rows)
+
+async def _notify_rows(app: Application, rows: List[Dict[str, Any]]) -> Tuple[int, int]:
+    cache = _CACHE
+    dirty: Dict[str, int] = {}
+    pending: Dict[str, Tuple[int, str]] = {}
+    retry = 0
+
+    ts = now_ist_str()   # one timestamp per batch
+    for deal in hot_rows(rows, cache):
+        key, pct = deal.key, deal.pct
+        if key not in pending or pct > pending[key][0]:
+            pending[key] = (pct, format_message(deal, ts))
+
+    sem = asyncio.Semaphore(SEND_CONCURRENCY)
+    digests = build_digests(pending)
+    results = await asyncio.gather(
+        *(send_digest(app, sem, d) for d in digests),
+        return_exceptions=True,
+    )
+    for (items, _), res in zip(digests, results):
+        if isinstance(res, BaseException):
+            if is_transient(res):
+                log.warning("[telegram] send failed, will retry next scan: %s", res)
+                retry += len(items)
+            else:
+                log.error("[telegram] send failed, dropping %s alert(s): %s", len(items), res)
+            continue
+        for key, pct in res:
+            remember(cache, key, pct)
+            dirty[key] = pct
+    append_cache(cache, dirty)
+    return len(dirty), retry
+
 # >>> Make this a JobQueue-style callback: it receives context, not application <<<
 async def scan_and_notify(context: ContextTypes.DEFAULT_TYPE) -> None:
     app: Application = context.application
-    print(f"[bot] scanning table '{SUPABASE_TABLE}' for >= 70% …")
-
-    sb = supabase_client()
-    # run blocking Supabase client in thread
-    rows = await asyncio.to_thread(fetch_all_rows, sb)
-
-    cache = load_cache()
-    sent = 0
-
-    for row in rows:
-        if row.get("product_id") is None and row.get("productId") is not None:
-            row["product_id"] = row["productId"]
-
-        pct = normalize_discount(row)
-        if pct is None or pct < 70:
-            continue
-
-        key = product_key(row)
-        prev = cache.get(key)
+    log.info("[bot] scanning table '%s' for >= %s%% …", SUPABASE_TABLE, MIN_DISCOUNT)
+
+    since = load_watermark()
+    started = datetime.now(timezone.utc) - WATERMARK_OVERLAP
+    rows = await fetch_all_rows(since)
+
+    sent, retry = await notify_rows(app, rows)
+    # Hold the watermark back only for transient send failures, so those rows are re-read
+    # next tick; permanently failing alerts are dropped rather than pinning it forever
+    if not retry:
+        save_watermark(started)
+    log.info("[bot] scan done. Alerts sent: %s", sent)
+
+# ===================== Realtime =====================
+
+def schedule_scans(app: Application, minutes: int, first: Optional[float] = None) -> None:
+    # (Re)register the periodic scan; first=None waits one interval before the first run.
+    for job in app.job_queue.get_jobs_by_name("scan_and_notify"):
+        job.schedule_removal()
+    app.job_queue.run_repeating(
+        scan_and_notify,
+        interval=minutes * 60,
+        first=first,
+        name="scan_and_notify",
+    )
 
-        if prev is None or prev < 70 or pct > prev:
-            text = format_message(row, pct)
-            try:
-                await app.bot.send_message(
-                    chat_id=int(TELEGRAM_CHAT_ID),
-                    text=text,
-                    parse_mode=ParseMode.HTML,
-                    disable_web_page_preview=True,
-                )
-                cache[key] = pct
-                sent += 1
-            except Exception as e:
-                print("[telegram] send failed:", e)
-
-    save_cache(cache)
-    print(f"[bot] scan done. Alerts sent: {sent}")
+def realtime_record(payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    # realtime-py nests the new row under data.record; accept the flat supabase-js shape too
+    data = payload.get("data") or payload
+    return data.get("record") or data.get("new")
+
+# Realtime client and its listen() task, kept so on_shutdown can close them
+_REALTIME_SB: Optional[Any] = None
+_REALTIME_TASK: "Optional[asyncio.Task[Any]]" = None
+
+async def start_realtime(app: Application) -> None:
+    # Needs the table in the supabase_realtime publication (see sql/003_realtime.sql).
+    global _REALTIME_SB, _REALTIME_TASK
+    sb = _REALTIME_SB = await acreate_client(SUPABASE_URL, SUPABASE_KEY)
+    await sb.realtime.connect()
+
+    def on_change(payload: Dict[str, Any]) -> None:
+        row = realtime_record(payload)
+        if row:
+            app.create_task(notify_rows(app, [row]))
+
+    channel = sb.channel("discounts")
+    for event in ("INSERT", "UPDATE"):
+        channel.on_postgres_changes(
+            event,
+            schema="public",
+            table=SUPABASE_TABLE,
+            filter=f"discount_pct=gte.{MIN_DISCOUNT}",
+            callback=on_change,
+        )
+    await channel.subscribe()
+    # post_init runs before Application.start(), so app.create_task wouldn't track this; we do
+    listener = _REALTIME_TASK = asyncio.create_task(sb.realtime.listen())
+
+    def on_listen_done(task: "asyncio.Task[Any]") -> None:
+        if task.cancelled() or not app.running:
+            return
+        log.warning("[realtime] listener stopped (%s); polling every %sm again", task.exception(), POLL_MINUTES)
+        schedule_scans(app, POLL_MINUTES, first=0)
+
+    listener.add_done_callback(on_listen_done)
+    schedule_scans(app, max(POLL_MINUTES, SAFETY_SCAN_MINUTES))
+    log.info("[realtime] subscribed to %s changes", SUPABASE_TABLE)
 
 # ===================== Startup & Main =====================
 
@@ -180,14 +445,68 @@ async def on_startup(app: Application) -> None:
         text=f"✅ Instamart discount bot up. Poll every {POLL_MINUTES}m.",
         disable_web_page_preview=True,
     )
+    if REALTIME:
+        try:
+            await start_realtime(app)
+        except Exception as e:
+            log.warning("[realtime] subscribe failed, relying on polling: %s", e)
     # kick off one scan immediately
     await scan_and_notify(ContextTypes.DEFAULT_TYPE(application=app))
 
+async def stop_realtime() -> None:
+    if _REALTIME_TASK is not None:
+        _REALTIME_TASK.cancel()
+        try:
+            await _REALTIME_TASK
+        except (asyncio.CancelledError, Exception):
+            pass   # cancelled, or it had already died (logged by on_listen_done)
+    if _REALTIME_SB is not None:
+        try:
+            await _REALTIME_SB.realtime.close()
+        except Exception as e:
+            log.warning("[realtime] close failed: %s", e)
+
+async def on_shutdown(app: Application) -> None:
+    await stop_realtime()
+    await _HTTP.aclose()
+
+def setup_logging() -> logging.handlers.QueueListener:
+    # Records are queued and written by a listener thread, so the event loop never blocks on stdout.
+    q: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(logging.handlers.QueueHandler(q))
+    logging.getLogger("httpx").setLevel(logging.WARNING)   # one INFO line per request otherwise
+    logging.getLogger("realtime").setLevel(logging.WARNING)   # logs every websocket frame, incl. the access token
+    listener = logging.handlers.QueueListener(q, stream)
+    listener.start()
+    return listener
+
 def main() -> None:
-    application: Application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    listener = setup_logging()
+    _CACHE.update(load_cache())
+    save_cache(_CACHE)   # compact the journal on startup
+
+    # Larger pool + HTTP/2 so concurrent alerts multiplex over one warm TLS connection.
+    # Needs the http2 extra: pip install "python-telegram-bot[http2]"
+    # All alerts go to one chat (~1 msg/s, 20 msg/min in groups): the rate limiter queues sends
+    # to stay under that and retries 429 RetryAfter. Needs the rate-limiter extra.
+    application: Application = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        .connection_pool_size(64)
+        .pool_timeout(10)
+        .http_version("2")
+        .get_updates_pool_timeout(10)
+        .build()
+    )
 
     # Requires installing the job-queue extra for PTB 21:
     # pip install "python-telegram-bot[job-queue]==21.6"
+    # Realtime (if enabled) stretches this to SAFETY_SCAN_MINUTES only once it has subscribed.
     application.job_queue.run_repeating(
         scan_and_notify,                 # <-- pass the async function directly
         interval=POLL_MINUTES * 60,
@@ -196,9 +515,13 @@ def main() -> None:
     )
 
     application.post_init = on_startup
+    application.post_shutdown = on_shutdown
 
-    print("[bot] starting…")
-    application.run_polling(close_loop=False)
+    log.info("[bot] starting…")
+    try:
+        application.run_polling(close_loop=False)
+    finally:
+        listener.stop()
 
 if __name__ == "__main__":
     main()
@@ -1,14 +1,20 @@
+import asyncio
 import json
+import logging
 import os
 import re
-import time
 import hashlib
+import time
+from dataclasses import dataclass, replace
 from datetime import datetime
-from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
-from urllib.parse import parse_qs, urlparse
+from functools import lru_cache
+from itertools import chain
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote_plus, urlencode, urlparse
 
-from playwright.sync_api import TimeoutError as PWTimeout
-from playwright.sync_api import sync_playwright
+import httpx
+from playwright.async_api import TimeoutError as PWTimeout
+from playwright.async_api import async_playwright
 
 try:
     from dotenv import load_dotenv
@@ -16,6 +22,18 @@ try:
 except ImportError:
     pass
 
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+try:
+    from xxhash import xxh3_64 as _row_hasher
+except ImportError:
+    def _row_hasher() -> Any:
+        return hashlib.blake2b(digest_size=8)
+
 try:
     from supabase import create_client
 except ImportError:
@@ -30,16 +48,26 @@ HEADLESS = True
 SLOWMO_MS = 0
 REQ_GAP_SEC = 0.8
 TILE_GAP_SEC = 4.0
+TILE_CONCURRENCY = 4    # tiles fetched in parallel; each worker still waits TILE_GAP_SEC between tiles
 SCROLL_PAUSE_MS = 250
 
 OUT_DIR = os.path.abspath("out_tiles")
 os.makedirs(OUT_DIR, exist_ok=True)
+STATE_PATH = os.path.join(OUT_DIR, "state.json")    # cookies/localStorage carried across cycles
+BROWSER_MAX_AGE_SEC = 24 * 3600                       # Chromium is kept across cycles, relaunched daily
 
 PARENTS: List[str] = [
     "https://www.swiggy.com/instamart/category-listing?categoryName=Dairy%2C+Bread+and+Eggs&custom_back=true&filterName=&offset=0&showAgeConsent=false&storeId=788745&taxonomyType=Speciality+taxonomy+1",
 ]
 
 TABLE_NAME = os.getenv("SUPABASE_TABLE", "instamart_products")
+UPSERT_RPC = os.getenv("SUPABASE_UPSERT_RPC", "upsert_instamart_products")    # sql/005_upsert_rpc.sql; "" disables
+
+log = logging.getLogger("instamart")
+
+_DISCOUNT_RE = re.compile(r"(\d+%)")
+_CATEGORY_RE = re.compile(r"[?&]categoryName=([^&#]*)")
+_MISSING: Dict[str, Any] = {}   # shared read-only stand-in for absent sub-objects; never mutate
 
 def ts() -> str:
     return datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -54,20 +82,70 @@ def qs_val(qs: Dict[str, List[str]], key: str, default: str = "") -> str:
 def decode_plus(s: str) -> str:
     return (s or "").replace("+", " ")
 
-def row_fingerprint(r: Dict[str, Any]) -> str:
-    parts = [
-        r.get("brand"),
-        r.get("discount"),
-        r.get("mrp"),
-        r.get("name"),
-        r.get("offer_price"),
-        r.get("sku"),
-        r.get("store_price"),
-    ]
-    s = "||".join("" if p is None else str(p) for p in parts)
-    return hashlib.md5(s.encode("utf-8")).hexdigest()
+@dataclass(frozen=True, slots=True)
+class TileContext:
+    origin: str
+    category: str
+    store_id: str
+    primary: str
+    secondary: str
+    taxonomy: str
+
+@lru_cache(maxsize=None)
+def _parse_url(url: str) -> TileContext:
+    # PARENTS is static, so each parent URL is only parsed once per process.
+    u = urlparse(url)
+    q = parse_qs(u.query)
+    store_id = qs_val(q, "storeId")
+    return TileContext(
+        origin=f"{u.scheme}://{u.netloc}",
+        category=decode_plus(qs_val(q, "categoryName")),
+        store_id=store_id,
+        primary=qs_val(q, "primaryStoreId", store_id),
+        secondary=qs_val(q, "secondaryStoreId", ""),
+        taxonomy=decode_plus(qs_val(q, "taxonomyType", "Speciality taxonomy 1")),
+    )
+
+def tile_context(base: TileContext, url: str) -> TileContext:
+    # A tile click only moves categoryName; a missing or blank one keeps the parent's.
+    # Everything else (incl. primaryStoreId/secondaryStoreId on the tile URL) stays the parent's.
+    m = _CATEGORY_RE.search(url)
+    if not m or not m.group(1):
+        return base
+    category = unquote_plus(m.group(1))
+    return base if category == base.category else replace(base, category=category)
+
+def row_fingerprint(*parts: Any) -> str:
+    # parts: brand, discount, mrp, name, offer_price, sku, store_price
+    # 64-bit change-detection hash (16 hex chars); xxh3 when installed, blake2b otherwise.
+    h = _row_hasher()
+    for p in parts:
+        if p is not None:
+            h.update(str(p).encode("utf-8"))
+        h.update(b"||")
+    return h.hexdigest()
+
+def _is_product_list(w: Dict[str, Any], _get=dict.get) -> bool:
+    wi = _get(w, "widgetInfo") or _MISSING
+    return (_get(wi, "widgetType") or _get(w, "type")) == "PRODUCT_LIST"
+
+def _widget_lists(w: Dict[str, Any], _get=dict.get) -> Iterator[List[Dict[str, Any]]]:
+    x = _get(w, "data")
+    if isinstance(x, list):
+        yield x
+    elif isinstance(x, dict):
+        for k in ("products", "cards", "items"):
+            v = _get(x, k)
+            if isinstance(v, list):
+                yield v
+
+def _widget_item_lists(widgets: List[Dict[str, Any]]) -> Iterator[List[Dict[str, Any]]]:
+    # Lazily yield product arrays from PRODUCT_LIST widgets; other widgets are never descended into.
+    return chain.from_iterable(map(_widget_lists, filter(_is_product_list, widgets)))
 
 def parse_items(payload: Dict[str, Any]) -> List[Dict[str, Any]]:
+    # Hands back the payload's own product list where there is one; only multiple
+    # PRODUCT_LIST widgets are concatenated into a new list.
     d = payload or {}
     items: List[Dict[str, Any]] = []
     if isinstance(d.get("products"), list):
@@ -79,19 +157,11 @@ def parse_items(payload: Dict[str, Any]) -> List[Dict[str, Any]]:
     if not items:
         widgets = d.get("data", {}).get("widgets", []) or d.get("pageWidgets", []) or []
         if isinstance(widgets, list):
-            lists = [
-                w for w in widgets
-                if (w.get("widgetInfo", {}).get("widgetType") or w.get("type")) == "PRODUCT_LIST"
-            ]
-            for w in lists:
-                x = w.get("data")
-                if isinstance(x, list):
-                    items.extend(x)
-                elif isinstance(x, dict):
-                    for k in ("products", "cards", "items"):
-                        v = x.get(k)
-                        if isinstance(v, list):
-                            items.extend(v)
+            lists = [v for v in _widget_item_lists(widgets) if v]
+            if len(lists) == 1:
+                items = lists[0]
+            elif lists:
+                items = [it for v in lists for it in v]
     if not items:
         cl = d.get("categoryListing", {})
         if isinstance(cl, dict) and isinstance(cl.get("products"), list):
@@ -104,22 +174,24 @@ def parse_items(payload: Dict[str, Any]) -> List[Dict[str, Any]]:
 def explode_item(x: Dict[str, Any],
                 tile_id: Optional[str] = None,
                 tile_name: Optional[str] = None,
-                category_name: Optional[str] = None) -> List[Dict[str, Any]]:
-    rows: List[Dict[str, Any]] = []
-    tag = x.get("listing_description") or x.get("product_description") or ""
-    m = re.search(r"(\d+%)", tag or "")
+                category_name: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    # Yields one row per variation straight into the caller's extend().
+    tag = x.get("listing_description") or x.get("product_description")
+    m = _DISCOUNT_RE.search(tag) if tag else None
     discount = m.group(1) if m else None
-    product_id = x.get("id") or x.get("product_id") or x.get("itemId") or x.get("info", {}).get("id")
-    name = x.get("display_name") or x.get("title") or x.get("name") or x.get("info", {}).get("name")
-    brand = x.get("brand") or x.get("info", {}).get("brand")
+    info = x.get("info") or _MISSING
+    product_id = x.get("id") or x.get("product_id") or x.get("itemId") or info.get("id")
+    name = x.get("display_name") or x.get("title") or x.get("name") or info.get("name")
+    brand = x.get("brand") or info.get("brand")
     variations = x.get("variations")
     if isinstance(variations, list) and variations:
+        x_price = x.get("price") or _MISSING
         for v in variations:
-            p = v.get("price") or {}
+            p = v.get("price") or _MISSING
             row = {
                 "brand": brand,
                 "discount": discount,
-                "mrp": p.get("mrp") or x.get("mrp") or x.get("price", {}).get("mrp"),
+                "mrp": p.get("mrp") or x.get("mrp") or x_price.get("mrp"),
                 "name": name,
                 "offer_price": p.get("offer_price") or x.get("offer_price") or x.get("finalPrice"),
                 "productId": product_id,
@@ -130,10 +202,10 @@ def explode_item(x: Dict[str, Any],
                 "tile_name": tile_name,
                 "category": category_name,
             }
-            rows.append(row)
+            yield row
     else:
-        p = (x.get("variations") or [{}])[0] if x.get("variations") else {}
-        price = p.get("price") or x.get("price") or {}
+        p = variations[0] if variations else _MISSING
+        price = p.get("price") or x.get("price") or _MISSING
         row = {
             "brand": brand,
             "discount": discount,
@@ -148,19 +220,7 @@ def explode_item(x: Dict[str, Any],
             "tile_name": tile_name,
             "category": category_name,
         }
-        rows.append(row)
-    return rows
-
-def dedupe_rows(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    seen: set[Tuple[Optional[str], Optional[str]]] = set()
-    out: List[Dict[str, Any]] = []
-    for r in rows:
-        key = (r.get("productId"), r.get("var_id"))
-        if key in seen:
-            continue
-        seen.add(key)
-        out.append(r)
-    return out
+        yield row
 
 def get_has_more(payload: Dict[str, Any]) -> Optional[bool]:
     d = payload.get("data") or payload
@@ -173,36 +233,30 @@ def get_has_more(payload: Dict[str, Any]) -> Optional[bool]:
         return hm
     return None
 
-def fetch_parent_all(page, category_name: str, store_id: str, primary: str, secondary: str, taxonomy: str, gap: float=0.8) -> List[Dict[str, Any]]:
+async def fetch_parent_all(client: httpx.AsyncClient, category_name: str, store_id: str, primary: str, secondary: str, taxonomy: str, gap: float=0.8) -> List[Dict[str, Any]]:
     collected: List[Dict[str, Any]] = []
     offset = 0
     step = 20
     max_retries = 3
+    params = {
+        "categoryName": category_name,
+        "storeId": store_id,
+        "filterName": "",
+        "primaryStoreId": primary,
+        "taxonomyType": taxonomy,
+    }
+    if secondary:
+        params["secondaryStoreId"] = secondary
+    # Only offset changes between pages, so the rest of the query is encoded once.
+    url_prefix = "/api/instamart/category-listing?" + urlencode(params) + "&offset="
     while True:
         for attempt in range(max_retries):
             try:
-                params = {
-                    "categoryName": category_name,
-                    "storeId": store_id,
-                    "offset": str(offset),
-                    "filterName": "",
-                    "primaryStoreId": primary,
-                    "taxonomyType": taxonomy,
-                }
-                if secondary:
-                    params["secondaryStoreId"] = secondary
-                payload = page.evaluate(
-                    """(params) => fetch('/api/instamart/category-listing?' + new URLSearchParams(params), {
-                        credentials:'same-origin',
-                        headers: {
-                            'Accept': 'application/json',
-                            'Content-Type': 'application/json'
-                        }
-                    }).then(r => r.json())""",
-                    params,
-                )
+                resp = await client.get(url_prefix + str(offset))
+                resp.raise_for_status()
+                payload = json_loads(resp.content)
                 items = parse_items(payload)
-                print(f"[parent] offset {offset} -> items {len(items)}")
+                log.info("[parent] offset %s -> items %s", offset, len(items))
                 if not items:
                     return collected
                 for it in items:
@@ -211,45 +265,39 @@ def fetch_parent_all(page, category_name: str, store_id: str, primary: str, seco
                 offset += step
                 if hm is False:
                     return collected
-                time.sleep(gap)
+                await asyncio.sleep(gap)
                 break
             except Exception as e:
-                print(f"[parent] fetch failed at offset {offset}, attempt {attempt + 1}: {e}")
+                log.warning("[parent] fetch failed at offset %s, attempt %s: %s", offset, attempt + 1, e)
                 if attempt == max_retries - 1:
                     return collected
-                time.sleep(1)
+                await asyncio.sleep(1)
     return collected
 
-def fetch_tile_get_all(page, category_name: str, store_id: str, primary: str, secondary: str, taxonomy: str, tile_id: str, tile_name: str, gap: float=0.6) -> List[Dict[str, Any]]:
+async def fetch_tile_get_all(client: httpx.AsyncClient, category_name: str, store_id: str, primary: str, secondary: str, taxonomy: str, tile_id: str, tile_name: str, gap: float=0.6) -> List[Dict[str, Any]]:
     out: List[Dict[str, Any]] = []
     offset = 0
     step = 20
     max_retries = 3
+    params = {
+        "categoryName": category_name,
+        "storeId": store_id,
+        "filterName": "",
+        "primaryStoreId": primary,
+        "taxonomyType": taxonomy,
+    }
+    if secondary:
+        params["secondaryStoreId"] = secondary
+    # Only offset changes between pages, so the rest of the query is encoded once.
+    url_prefix = "/api/instamart/category-listing?" + urlencode(params) + "&offset="
     while True:
         for attempt in range(max_retries):
             try:
-                params = {
-                    "categoryName": category_name,
-                    "storeId": store_id,
-                    "offset": str(offset),
-                    "filterName": "",
-                    "primaryStoreId": primary,
-                    "taxonomyType": taxonomy,
-                }
-                if secondary:
-                    params["secondaryStoreId"] = secondary
-                payload = page.evaluate(
-                    """(params) => fetch('/api/instamart/category-listing?' + new URLSearchParams(params), {
-                        credentials:'same-origin',
-                        headers: {
-                            'Accept': 'application/json',
-                            'Content-Type': 'application/json'
-                        }
-                    }).then(r => r.json())""",
-                    params,
-                )
+                resp = await client.get(url_prefix + str(offset))
+                resp.raise_for_status()
+                payload = json_loads(resp.content)
                 got = parse_items(payload)
-                print(f"[tile-GET:{tile_name}] offset {offset} -> items {len(got)}")
+                log.info("[tile-GET:%s] offset %s -> items %s", tile_name, offset, len(got))
                 if not got:
                     return out
                 for it in got:
@@ -258,50 +306,42 @@ def fetch_tile_get_all(page, category_name: str, store_id: str, primary: str, se
                 offset += step
                 if hm is False:
                     return out
-                time.sleep(gap)
+                await asyncio.sleep(gap)
                 break
             except Exception as e:
-                print(f"[tile-GET:{tile_name}] fetch failed at offset {offset}, attempt {attempt + 1}: {e}")
+                log.warning("[tile-GET:%s] fetch failed at offset %s, attempt %s: %s", tile_name, offset, attempt + 1, e)
                 if attempt == max_retries - 1:
                     return out
-                time.sleep(1)
+                await asyncio.sleep(1)
     return out
 
-def fetch_tile_post_all(page, filter_id: str, category_name: str, store_id: str, primary: str, secondary: str, taxonomy: str, tile_name: str, gap: float=0.6) -> List[Dict[str, Any]]:
+async def fetch_tile_post_all(client: httpx.AsyncClient, filter_id: str, category_name: str, store_id: str, primary: str, secondary: str, taxonomy: str, tile_name: str, gap: float=0.6) -> List[Dict[str, Any]]:
     out: List[Dict[str, Any]] = []
     page_no = 0
     limit = 40
     max_retries = 3
+    params = {
+        "filterId": filter_id,
+        "storeId": store_id,
+        "offset": "0",
+        "primaryStoreId": primary,
+        "type": taxonomy,
+        "limit": str(limit),
+        "filterName": "",
+        "categoryName": category_name,
+    }
+    if secondary:
+        params["secondaryStoreId"] = secondary
+    # Only pageNo changes between pages, so the rest of the query is encoded once.
+    url_prefix = "/api/instamart/category-listing/filter?" + urlencode(params) + "&pageNo="
     while True:
         for attempt in range(max_retries):
             try:
-                params = {
-                    "filterId": filter_id,
-                    "storeId": store_id,
-                    "offset": "0",
-                    "primaryStoreId": primary,
-                    "type": taxonomy,
-                    "pageNo": str(page_no),
-                    "limit": str(limit),
-                    "filterName": "",
-                    "categoryName": category_name,
-                }
-                if secondary:
-                    params["secondaryStoreId"] = secondary
-                payload2 = page.evaluate(
-                    """(params) => fetch('/api/instamart/category-listing/filter?' + new URLSearchParams(params), {
-                        method: 'POST',
-                        credentials: 'same-origin',
-                        headers: {
-                            'Content-Type': 'application/json',
-                            'Accept': 'application/json'
-                        },
-                        body: '{}'
-                    }).then(r => r.json())""",
-                    params,
-                )
+                resp = await client.post(url_prefix + str(page_no), content=b"{}")
+                resp.raise_for_status()
+                payload2 = json_loads(resp.content)
                 got = parse_items(payload2)
-                print(f"[tile-POST:{tile_name}] pageNo {page_no} -> items {len(got)}")
+                log.info("[tile-POST:%s] pageNo %s -> items %s", tile_name, page_no, len(got))
                 if not got:
                     return out
                 for it in got:
@@ -310,35 +350,61 @@ def fetch_tile_post_all(page, filter_id: str, category_name: str, store_id: str,
                 page_no += 1
                 if hm is False:
                     return out
-                time.sleep(gap)
+                await asyncio.sleep(gap)
                 break
             except Exception as e:
-                print(f"[tile-POST:{tile_name}] fetch failed at pageNo {page_no}, attempt {attempt + 1}: {e}")
+                log.warning("[tile-POST:%s] fetch failed at pageNo %s, attempt %s: %s", tile_name, page_no, attempt + 1, e)
                 if attempt == max_retries - 1:
                     return out
-                time.sleep(1)
+                await asyncio.sleep(1)
     return out
 
+async def api_client(ctx, page, base_url: str) -> httpx.AsyncClient:
+    # The listing endpoints are plain JSON APIs: once the page has a session, call them
+    # directly with its cookies over HTTP/2 instead of a CDP round-trip per request.
+    cookies = {c["name"]: c["value"] for c in await ctx.cookies(base_url)}
+    user_agent = await page.evaluate("() => navigator.userAgent")
+    return httpx.AsyncClient(
+        base_url=base_url,
+        http2=True,
+        cookies=cookies,
+        headers={
+            "User-Agent": user_agent,
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+            "Referer": page.url,
+        },
+        timeout=30,
+    )
+
 def init_supabase() -> Optional[SupabaseClient]:
     url = os.getenv("SUPABASE_URL")
     key = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("SUPABASE_ANON_KEY")
     if not url or not key:
-        print("[supabase] Missing SUPABASE_URL or key (SUPABASE_SERVICE_ROLE_KEY / SUPABASE_ANON_KEY). Skipping DB writes.")
+        log.warning("[supabase] Missing SUPABASE_URL or key (SUPABASE_SERVICE_ROLE_KEY / SUPABASE_ANON_KEY). Skipping DB writes.")
         return None
     if create_client is None:
-        print("[supabase] 'supabase' package not installed. Run: pip install supabase")
+        log.warning("[supabase] 'supabase' package not installed. Run: pip install supabase")
         return None
     try:
         client: SupabaseClient = create_client(url, key)
-        print("[supabase] Client initialized.")
+        log.info("[supabase] Client initialized.")
         return client
     except Exception as e:
-        print(f"[supabase] Failed to init client: {e}")
+        log.error("[supabase] Failed to init client: %s", e)
         return None
 
 def compute_discount_str(mrp: Any, offer: Any, existing: Optional[str]) -> Optional[str]:
     if existing:
         return existing
+    if type(mrp) is int and type(offer) is int:
+        # Rupee prices are usually ints: integer math, same result as round() (ties to even)
+        if mrp > 0 and offer <= mrp:
+            pct, rem = divmod((mrp - offer) * 100, mrp)
+            if 2 * rem > mrp or (2 * rem == mrp and pct & 1):
+                pct += 1
+            return f"{pct}%"
+        return existing
     try:
         if mrp is not None and offer is not None:
             mrp_val = float(mrp)
@@ -351,267 +417,295 @@ def compute_discount_str(mrp: Any, offer: Any, existing: Optional[str]) -> Optio
     return existing
 
 def rows_for_db(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    out: List[Dict[str, Any]] = []
-    for r in rows or []:
-        row = {
-            "brand": r.get("brand"),
-            "mrp": r.get("mrp"),
-            "name": r.get("name"),
-            "offer_price": r.get("offer_price"),
-            "product_id": (str(r.get("productId")) if r.get("productId") is not None else None),
-            "sku": r.get("sku"),
-            "store_price": r.get("store_price"),
-            "var_id": (str(r.get("var_id")) if r.get("var_id") is not None else None),
+    # Column-wise: one pass per field, discounts and hashes straight from the columns,
+    # and the per-row dicts only built once at the Supabase boundary.
+    rows = rows or []
+    brands = [r.get("brand") for r in rows]
+    mrps = [r.get("mrp") for r in rows]
+    names = [r.get("name") for r in rows]
+    offers = [r.get("offer_price") for r in rows]
+    pids = [None if v is None else str(v) for v in [r.get("productId") for r in rows]]
+    skus = [r.get("sku") for r in rows]
+    stores = [r.get("store_price") for r in rows]
+    vids = [None if v is None else str(v) for v in [r.get("var_id") for r in rows]]
+    discount_str = compute_discount_str
+    discounts = [discount_str(m, o, d) for m, o, d in zip(mrps, offers, [r.get("discount") for r in rows])]
+    hashes = [row_fingerprint(*cols) for cols in zip(brands, discounts, mrps, names, offers, skus, stores)]
+    return [
+        {
+            "brand": b,
+            "mrp": m,
+            "name": n,
+            "offer_price": o,
+            "product_id": p,
+            "sku": k,
+            "store_price": st,
+            "var_id": v,
+            "discount": d,
+            "data_hash": h,
         }
-        row["discount"] = compute_discount_str(row["mrp"], row["offer_price"], r.get("discount"))
-        row["data_hash"] = row_fingerprint(row)
-        out.append(row)
-    return out
+        for b, m, n, o, p, k, st, v, d, h in zip(brands, mrps, names, offers, pids, skus, stores, vids, discounts, hashes)
+    ]
 
-def _try_fetch_existing(sb: SupabaseClient, table: str, prod_ids: List[str], var_ids: List[str]) -> Tuple[Dict[Tuple[str, str], Optional[str]], bool]:
-    existing: Dict[Tuple[str, str], Optional[str]] = {}
-    hash_present = True
-    if not prod_ids or not var_ids:
-        return existing, hash_present
+_rpc_missing = False    # set once PostgREST reports the function doesn't exist; not retried after that
+
+def _upsert_rpc(sb: SupabaseClient, rows: List[Dict[str, Any]]) -> Optional[int]:
+    # Whole scrape in one call; Postgres skips rows whose data_hash is unchanged.
+    # None means the call failed and the caller should fall back.
+    global _rpc_missing
     try:
-        resp = (
-            sb.table(table)
-              .select("product_id,var_id,data_hash")
-              .in_("product_id", prod_ids)
-              .in_("var_id", var_ids)
-              .execute()
-        )
-        for row in resp.data or []:
-            pid = row.get("product_id")
-            vid = row.get("var_id")
-            if pid is not None and vid is not None:
-                existing[(pid, vid)] = row.get("data_hash")
-        return existing, hash_present
+        resp = sb.rpc(UPSERT_RPC, {"rows": rows}).execute()
     except Exception as e:
-        print(f"[supabase] fetch existing with data_hash failed (will retry without hash): {e}")
-        try:
-            hash_present = False
-            resp = (
-                sb.table(table)
-                  .select("product_id,var_id")
-                  .in_("product_id", prod_ids)
-                  .in_("var_id", var_ids)
-                  .execute()
-            )
-            for row in resp.data or []:
-                pid = row.get("product_id")
-                vid = row.get("var_id")
-                if pid is not None and vid is not None:
-                    existing[(pid, vid)] = None
-        except Exception as e2:
-            print(f"[supabase] fetch existing keys failed: {e2}")
-    return existing, hash_present
+        if getattr(e, "code", None) == "PGRST202":    # function not found in the schema cache
+            _rpc_missing = True
+            log.warning("[supabase] rpc %s not installed (sql/005_upsert_rpc.sql); using batched upserts from now on", UPSERT_RPC)
+        else:
+            log.warning("[supabase] rpc %s failed (falling back to batched upsert): %s", UPSERT_RPC, e)
+        return None
+    return resp.data if isinstance(resp.data, int) else 0
 
 def upsert_batches(sb, table, rows, batch_size=400):
     if not sb or not rows:
         return
-    total_new = total_changed = total_skipped = 0
-    for i in range(0, len(rows), batch_size):
-        batch = rows[i:i+batch_size]
-        valid_batch = [r for r in batch if r.get("product_id") is not None and r.get("var_id") is not None]
-        if not valid_batch:
-            print(f"[supabase] no valid rows in batch {i//batch_size+1}")
-            continue
-        keys = [(r["product_id"], r["var_id"]) for r in valid_batch]
-        prod_ids = [k[0] for k in keys]
-        var_ids = [k[1] for k in keys]
-        existing: Dict[Tuple[str, str], Optional[str]] = {}
-        hash_present = True
-        if prod_ids and var_ids:
-            existing, hash_present = _try_fetch_existing(sb, table, prod_ids, var_ids)
-        delta = []
-        for r in valid_batch:
-            key = (r["product_id"], r["var_id"])
-            if key not in existing:
-                delta.append(r)
-                total_new += 1
-                continue
-            ex_hash = existing.get(key)
-            if not hash_present:
-                delta.append(r)
-                total_changed += 1
-                continue
-            if ex_hash is None or ex_hash != r.get("data_hash"):
-                delta.append(r)
-                total_changed += 1
-            else:
-                total_skipped += 1
-        if not delta:
-            print(f"[supabase] nothing to upsert in batch {i//batch_size+1}")
-            continue
+    valid = [r for r in rows if r.get("product_id") is not None and r.get("var_id") is not None]
+    if not valid:
+        log.info("[supabase] no valid rows to upsert")
+        return
+    if UPSERT_RPC and not _rpc_missing:
+        written = _upsert_rpc(sb, valid)
+        if written is not None:
+            log.info("[supabase] rpc upsert: %s new or changed, %s unchanged", written, len(valid) - written)
+            return
+    # Fallback without the RPC: plain PostgREST upserts of every row, no unchanged-row skip.
+    for i in range(0, len(valid), batch_size):
+        batch = valid[i:i+batch_size]
         try:
-            sb.table(table).upsert(delta, on_conflict="product_id,var_id").execute()
-            print(f"[supabase] upserted {len(delta)} rows into {table}.")
+            sb.table(table).upsert(batch, on_conflict="product_id,var_id").execute()
+            log.info("[supabase] upserted %s rows into %s.", len(batch), table)
         except Exception as e:
-            print(f"[supabase] upsert failed for batch {i//batch_size+1}: {e}")
-    print(f"[supabase] summary: new={total_new}, changed={total_changed}, skipped={total_skipped}")
+            log.error("[supabase] upsert failed for batch %s: %s", i // batch_size + 1, e)
 
-def run() -> None:
-    sb = init_supabase()
-    while True:
-        with sync_playwright() as pw:
-            browser = pw.chromium.launch(headless=HEADLESS, slow_mo=SLOWMO_MS)
-            try:
-                ctx = browser.new_context(
-                    user_agent=(
-                        "Mozilla/5.0 (Linux; Android 6.0; Nexus 5 Build/MRA58N) "
-                        "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/139.0.0.0 Mobile Safari/537.36"
-                    ),
-                    viewport={"width": 375, "height": 667}
+async def fetch_tile_all(client: httpx.AsyncClient, t: Dict[str, str], label: str, tc: TileContext) -> List[Dict[str, Any]]:
+    # POST filter endpoint first, then the GET listing by category, then by tile label.
+    category, store_id, primary, secondary, taxonomy = tc.category, tc.store_id, tc.primary, tc.secondary, tc.taxonomy
+    tile_total: List[Dict[str, Any]] = []
+    try:
+        tile_total.extend(
+            await fetch_tile_post_all(
+                client,
+                t["filterId"],
+                category,
+                store_id,
+                primary,
+                secondary,
+                taxonomy,
+                tile_name=t["name"],
+                gap=0.6,
+            )
+        )
+    except Exception as e:
+        log.warning("[tile-POST] error: %s", e)
+    if not tile_total:
+        try:
+            tile_total.extend(
+                await fetch_tile_get_all(
+                    client,
+                    category,
+                    store_id,
+                    primary,
+                    secondary,
+                    taxonomy,
+                    tile_id=t["filterId"],
+                    tile_name=t["name"],
+                    gap=0.6,
                 )
-                page = ctx.new_page()
-                for parent in PARENTS:
-                    print(f"\n=== PARENT: {parent} ===")
-                    try:
-                        page.goto(parent, wait_until="networkidle", timeout=45000)
-                    except Exception as e:
-                        print(f"[fatal] {parent}: goto failed: {e}")
-                        continue
-                    time.sleep(2)
-                    try:
-                        page.wait_for_selector('li[data-itemid]', timeout=15000)
-                    except PWTimeout:
-                        print("[grid] tiles not visible yet, scrolling to trigger render…")
-                        try:
-                            for _ in range(5):
-                                page.evaluate("window.scrollBy(0, window.innerHeight * 0.5)")
-                                time.sleep(SCROLL_PAUSE_MS / 1000)
-                            page.wait_for_selector('li[data-itemid]', timeout=8000)
-                        except Exception as ex:
-                            print(f"[warn] Could not find tiles after scrolling: {ex}")
-                            continue
-                    try:
-                        tiles: List[Dict[str, str]] = page.evaluate(
-                            """
-                            () => {
-                                const nodes = Array.from(document.querySelectorAll('li[data-itemid]'));
-                                return nodes.map(n => {
-                                    const filterId = n.getAttribute('data-itemid') || '';
-                                    let labelEl = n.querySelector('[class*="aXZVg"]') || n.querySelector('div span') || n.querySelector('span') || n.querySelector('div');
-                                    let name = '';
-                                    if (labelEl) {
-                                        name = (labelEl.textContent || '').trim();
-                                    } else {
-                                        name = (n.innerText || '').trim();
-                                    }
-                                    name = name.split('\\n').filter(line => line.trim()).pop() || '';
-                                    return (filterId && name) ? { filterId, name } : null;
-                                }).filter(Boolean);
+            )
+        except Exception as e:
+            log.warning("[tile-GET] error: %s", e)
+    if not tile_total:
+        try:
+            tile_total.extend(
+                await fetch_tile_get_all(
+                    client,
+                    t["name"],
+                    store_id,
+                    primary,
+                    secondary,
+                    taxonomy,
+                    tile_id=t["filterId"],
+                    tile_name=t["name"],
+                    gap=0.6,
+                )
+            )
+        except Exception as e:
+            log.warning("[tile-GET(label)] error: %s", e)
+    log.info("   -> total products for %s: %s", label, len(tile_total))
+    return tile_total
+
+async def new_context(browser: Any) -> Any:
+    opts: Dict[str, Any] = {
+        "user_agent": (
+            "Mozilla/5.0 (Linux; Android 6.0; Nexus 5 Build/MRA58N) "
+            "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/139.0.0.0 Mobile Safari/537.36"
+        ),
+        "viewport": {"width": 375, "height": 667},
+    }
+    if os.path.exists(STATE_PATH):
+        try:
+            return await browser.new_context(storage_state=STATE_PATH, **opts)
+        except Exception as e:
+            # Unreadable state must not wedge every restart: drop it and start clean
+            log.warning("[browser] saved storage state unusable, discarding it: %s", e)
+            try:
+                os.remove(STATE_PATH)
+            except OSError:
+                pass
+    return await browser.new_context(**opts)
+
+async def save_storage_state(ctx: Any) -> None:
+    # Written to a temp file and renamed, so a kill mid-write never leaves a truncated state.json.
+    tmp = STATE_PATH + ".tmp"
+    try:
+        await ctx.storage_state(path=tmp)
+        os.replace(tmp, STATE_PATH)
+    except Exception as e:
+        log.warning("[warn] could not save storage state: %s", e)
+
+async def scrape_cycle(browser: Any, sb: Optional[SupabaseClient]) -> None:
+    ctx = await new_context(browser)
+    try:
+        page = await ctx.new_page()
+        for parent in PARENTS:
+            log.info("=== PARENT: %s ===", parent)
+            try:
+                await page.goto(parent, wait_until="networkidle", timeout=45000)
+            except Exception as e:
+                log.error("[fatal] %s: goto failed: %s", parent, e)
+                continue
+            await asyncio.sleep(2)
+            try:
+                await page.wait_for_selector('li[data-itemid]', timeout=15000)
+            except PWTimeout:
+                log.info("[grid] tiles not visible yet, scrolling to trigger render…")
+                try:
+                    for _ in range(5):
+                        await page.evaluate("window.scrollBy(0, window.innerHeight * 0.5)")
+                        await asyncio.sleep(SCROLL_PAUSE_MS / 1000)
+                    await page.wait_for_selector('li[data-itemid]', timeout=8000)
+                except Exception as ex:
+                    log.warning("[warn] Could not find tiles after scrolling: %s", ex)
+                    continue
+            try:
+                tiles: List[Dict[str, str]] = await page.evaluate(
+                    """
+                    () => {
+                        const nodes = Array.from(document.querySelectorAll('li[data-itemid]'));
+                        return nodes.map(n => {
+                            const filterId = n.getAttribute('data-itemid') || '';
+                            let labelEl = n.querySelector('[class*="aXZVg"]') || n.querySelector('div span') || n.querySelector('span') || n.querySelector('div');
+                            let name = '';
+                            if (labelEl) {
+                                name = (labelEl.textContent || '').trim();
+                            } else {
+                                name = (n.innerText || '').trim();
                             }
-                            """
-                        )
-                    except Exception as e:
-                        print(f"[warn] Failed to collect tiles: {e}")
-                        tiles = []
-                    print(f"[tiles] discovered: {len(tiles)}")
-                    u = urlparse(parent)
-                    q = parse_qs(u.query)
-                    category_name = decode_plus(qs_val(q, "categoryName"))
-                    store_id = qs_val(q, "storeId")
-                    primary = qs_val(q, "primaryStoreId", store_id)
-                    secondary = qs_val(q, "secondaryStoreId", "")
-                    taxonomy = decode_plus(qs_val(q, "taxonomyType", "Speciality taxonomy 1"))
-                    collected: List[Dict[str, Any]] = []
-                    try:
-                        parent_items = fetch_parent_all(page, category_name, store_id, primary, secondary, taxonomy, gap=REQ_GAP_SEC)
-                        collected.extend(parent_items)
-                        print(f"[parent] collected {len(parent_items)} items")
-                    except Exception as e:
-                        print(f"[warn] parent fetch failed: {e}")
-                    for idx, t in enumerate(tiles, start=1):
-                        print(f"[tile {idx}/{len(tiles)}] {t['name']} ({t['filterId']})")
-                        try:
-                            loc = page.locator(f'li[data-itemid="{t["filterId"]}"]')
-                            loc.scroll_into_view_if_needed(timeout=8000)
-                            loc.click(timeout=8000)
-                            try:
-                                page.wait_for_load_state("networkidle", timeout=10000)
-                            except Exception:
-                                page.wait_for_selector('div[data-testid="product-card"]', timeout=10000)
-                        except Exception as e:
-                            print(f"[warn] Failed for tile {t['name']}: {e}")
-                            continue
-                        u2 = urlparse(page.url)
-                        q2 = parse_qs(u2.query)
-                        now_category = decode_plus(qs_val(q2, "categoryName", category_name))
-                        now_primary = qs_val(q2, "primaryStoreId", primary)
-                        now_secondary = qs_val(q2, "secondaryStoreId", secondary)
-                        now_taxonomy = decode_plus(qs_val(q2, "taxonomyType", taxonomy))
-                        print(f"   -> tile context: category='{now_category}', primary='{now_primary}', secondary='{now_secondary}', taxonomy='{now_taxonomy}'")
-                        tile_total: List[Dict[str, Any]] = []
-                        try:
-                            tile_total.extend(
-                                fetch_tile_post_all(
-                                    page,
-                                    t["filterId"],
-                                    now_category,
-                                    store_id,
-                                    now_primary,
-                                    now_secondary,
-                                    now_taxonomy,
-                                    tile_name=t["name"],
-                                    gap=0.6,
-                                )
-                            )
-                        except Exception as e:
-                            print(f"[tile-POST] error: {e}")
-                        if not tile_total:
-                            try:
-                                tile_total.extend(
-                                    fetch_tile_get_all(
-                                        page,
-                                        now_category,
-                                        store_id,
-                                        now_primary,
-                                        now_secondary,
-                                        now_taxonomy,
-                                        tile_id=t["filterId"],
-                                        tile_name=t["name"],
-                                        gap=0.6,
-                                    )
-                                )
-                            except Exception as e:
-                                print(f"[tile-GET] error: {e}")
-                        if not tile_total:
-                            try:
-                                tile_total.extend(
-                                    fetch_tile_get_all(
-                                        page,
-                                        t["name"],
-                                        store_id,
-                                        now_primary,
-                                        now_secondary,
-                                        now_taxonomy,
-                                        tile_id=t["filterId"],
-                                        tile_name=t["name"],
-                                        gap=0.6,
-                                    )
-                                )
-                            except Exception as e:
-                                print(f"[tile-GET(label)] error: {e}")
-                        print(f"   -> total products for tile {idx}: {len(tile_total)}")
-                        collected.extend(tile_total)
-                        time.sleep(TILE_GAP_SEC)
-                    collected = dedupe_rows(collected)
-                    print(f"[done] unique rows: {len(collected)}")
+                            name = name.split('\\n').filter(line => line.trim()).pop() || '';
+                            return (filterId && name) ? { filterId, name } : null;
+                        }).filter(Boolean);
+                    }
+                    """
+                )
+            except Exception as e:
+                log.warning("[warn] Failed to collect tiles: %s", e)
+                tiles = []
+            log.info("[tiles] discovered: %s", len(tiles))
+            base = _parse_url(parent)
+            # Clicking tiles drives the page, so their contexts are resolved one at a time...
+            jobs: List[Tuple[Dict[str, str], str, TileContext]] = []
+            for idx, t in enumerate(tiles, start=1):
+                log.info("[tile %s/%s] %s (%s)", idx, len(tiles), t["name"], t["filterId"])
+                try:
+                    loc = page.locator(f'li[data-itemid="{t["filterId"]}"]')
+                    await loc.scroll_into_view_if_needed(timeout=8000)
+                    await loc.click(timeout=8000)
                     try:
-                        db_rows = rows_for_db(collected)
-                        upsert_batches(sb, TABLE_NAME, db_rows, batch_size=400)
-                    except Exception as e:
-                        print(f"[db error] {e}")
-            finally:
+                        await page.wait_for_load_state("networkidle", timeout=10000)
+                    except Exception:
+                        await page.wait_for_selector('div[data-testid="product-card"]', timeout=10000)
+                except Exception as e:
+                    log.warning("[warn] Failed for tile %s: %s", t["name"], e)
+                    continue
+                tc = tile_context(base, page.url)
+                log.info("   -> tile context: category=%r, primary=%r, secondary=%r, taxonomy=%r", tc.category, tc.primary, tc.secondary, tc.taxonomy)
+                jobs.append((t, f"tile {idx}", tc))
+            # ...then the API pagination (the slow, sleep-bound part) runs TILE_CONCURRENCY tiles at a time
+            # over direct HTTP calls that reuse the browser session's cookies.
+            try:
+                client = await api_client(ctx, page, base.origin)
+            except Exception as e:
+                log.warning("[warn] could not build API client for %s: %s", parent, e)
+                continue
+            # First row per (productId, var_id) wins; dicts keep insertion order.
+            collected: Dict[Tuple[Any, Any], Dict[str, Any]] = {}
+            sem = asyncio.Semaphore(TILE_CONCURRENCY)
+
+            async def fetch_job(job: Tuple[Dict[str, str], str, TileContext]) -> List[Dict[str, Any]]:
+                t, label, tc = job
+                async with sem:
+                    got = await fetch_tile_all(client, t, label, tc)
+                    await asyncio.sleep(TILE_GAP_SEC)
+                    return got
+
+            async with client:
                 try:
-                    browser.close()
-                except Exception:
-                    pass
-        wait_secs = 5 * 60
-        print(f"[scraper] Sleeping for {wait_secs//60} minutes before next cycle...")
-        time.sleep(wait_secs)
+                    parent_items = await fetch_parent_all(client, base.category, base.store_id, base.primary, base.secondary, base.taxonomy, gap=REQ_GAP_SEC)
+                    for r in parent_items:
+                        collected.setdefault((r["productId"], r["var_id"]), r)
+                    log.info("[parent] collected %s items", len(parent_items))
+                except Exception as e:
+                    log.warning("[warn] parent fetch failed: %s", e)
+                for tile_total in await asyncio.gather(*(fetch_job(job) for job in jobs)):
+                    for r in tile_total:
+                        collected.setdefault((r["productId"], r["var_id"]), r)
+            log.info("[done] unique rows: %s", len(collected))
+            try:
+                db_rows = rows_for_db(list(collected.values()))
+                # Sync supabase client: keep the event loop (and Playwright) responsive during the upload
+                await asyncio.to_thread(upsert_batches, sb, TABLE_NAME, db_rows, 400)
+            except Exception as e:
+                log.error("[db error] %s", e)
+        await save_storage_state(ctx)
+    finally:
+        try:
+            await ctx.close()
+        except Exception:
+            pass
+
+async def run() -> None:
+    sb = init_supabase()
+    async with async_playwright() as pw:
+        browser = None
+        launched = 0.0
+        while True:
+            try:
+                if browser is None or not browser.is_connected() or time.monotonic() - launched > BROWSER_MAX_AGE_SEC:
+                    if browser is not None:
+                        try:
+                            await browser.close()
+                        except Exception:
+                            pass
+                    browser = await pw.chromium.launch(headless=HEADLESS, slow_mo=SLOWMO_MS)
+                    launched = time.monotonic()
+                    log.info("[browser] launched")
+                await scrape_cycle(browser, sb)
+            except Exception as e:
+                # One bad cycle (browser crash, context failure, ...) must not end the loop
+                log.exception("[scraper] cycle failed: %s", e)
+            wait_secs = 5 * 60
+            log.info("[scraper] Sleeping for %s minutes before next cycle...", wait_secs // 60)
+            await asyncio.sleep(wait_secs)
 
 if __name__ == "__main__":
-    run()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    asyncio.run(run())
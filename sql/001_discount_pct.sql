@@ -0,0 +1,15 @@
+-- Discount percentage computed by Postgres so the bot can filter server-side
+-- (`discount_pct=gte.70`) instead of downloading the whole table every poll.
+-- Mirrors bot.normalize_discount: prefer the scraped "72%" label, else derive from mrp/offer_price.
+
+alter table public.instamart_products
+  add column if not exists discount_pct integer
+  generated always as (
+    coalesce(
+      substring(discount from '(\d+)')::integer,
+      case
+        when mrp > 0 and offer_price <= mrp
+          then round((mrp - offer_price)::numeric / mrp * 100)::integer
+      end
+    )
+  ) stored;
@@ -0,0 +1,27 @@
+-- Row-change watermark for the bot's incremental scan (`updated_at=gte.<last scan>`).
+-- The trigger bumps updated_at only when data_hash changes, so re-upserting an unchanged row
+-- (the scraper's batched fallback rewrites every row) doesn't pull it back into the bot's scan.
+-- Safe to re-run: it replaces the trigger in place.
+
+alter table public.instamart_products
+  add column if not exists updated_at timestamptz not null default now();
+
+create or replace function public.instamart_products_touch()
+returns trigger
+language plpgsql
+as $$
+begin
+  new.updated_at := now();
+  return new;
+end;
+$$;
+
+drop trigger if exists instamart_products_touch on public.instamart_products;
+create trigger instamart_products_touch
+  before update on public.instamart_products
+  for each row
+  when (old.data_hash is distinct from new.data_hash)
+  execute function public.instamart_products_touch();
+
+create index if not exists idx_instamart_products_updated_at
+  on public.instamart_products (updated_at);
@@ -0,0 +1,3 @@
+-- Optional: stream row changes to the bot (SUPABASE_REALTIME=1).
+
+alter publication supabase_realtime add table public.instamart_products;
@@ -0,0 +1,8 @@
+-- Partial index over the rows the bot can alert on, so its `discount_pct=gte.70` query
+-- costs O(matches) instead of O(table). Keyed on updated_at so the incremental
+-- `updated_at=gte.<watermark>` scan is a range scan inside it; a full scan just walks it.
+-- Queries with a higher MIN_DISCOUNT still qualify (>= 75 implies >= 70).
+
+create index if not exists idx_hot_discount
+  on public.instamart_products (updated_at)
+  where discount_pct >= 70;
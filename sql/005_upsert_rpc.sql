@@ -0,0 +1,29 @@
+-- One-call upsert for the scraper: `sb.rpc("upsert_instamart_products", {"rows": [...]})`
+-- replaces one PostgREST request per 400-row batch. Unchanged rows (same data_hash) are
+-- skipped by the conflict predicate, so they are neither rewritten nor touched by the
+-- updated_at trigger. Explicit columns: discount_pct is generated and updated_at defaulted.
+-- Returns the number of rows inserted or updated.
+
+create or replace function public.upsert_instamart_products(rows jsonb)
+returns integer
+language sql
+as $$
+  with up as (
+    insert into public.instamart_products as t
+      (product_id, var_id, brand, name, sku, mrp, offer_price, store_price, discount, data_hash)
+    select product_id, var_id, brand, name, sku, mrp, offer_price, store_price, discount, data_hash
+    from jsonb_populate_recordset(null::public.instamart_products, rows)
+    on conflict (product_id, var_id) do update set
+      brand = excluded.brand,
+      name = excluded.name,
+      sku = excluded.sku,
+      mrp = excluded.mrp,
+      offer_price = excluded.offer_price,
+      store_price = excluded.store_price,
+      discount = excluded.discount,
+      data_hash = excluded.data_hash
+    where t.data_hash is distinct from excluded.data_hash
+    returning 1
+  )
+  select count(*)::integer from up;
+$$;